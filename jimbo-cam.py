@@ -1,14 +1,28 @@
 #!/usr/bin/env python3
+import io
 import os
 import time
+import queue
+import random
 import uuid
 import signal
+import socket
+import threading
 import logging
+import numpy as np
 import requests
+from dataclasses import dataclass, fields
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from pathlib import Path
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
 from libcamera import controls
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+
 import subprocess
 import getpass
 import sys
@@ -39,16 +53,35 @@ load_env_file(ENV_PATH)
 
 
 # ======== Environment Variables ========
-PRUSA_URL = os.getenv("PRUSA_URL", "https://webcam.connect.prusa3d.com/c/snapshot")
-PRUSA_TOKEN = os.getenv("PRUSA_TOKEN", "").strip()
-PRUSA_FINGERPRINT = os.getenv("PRUSA_FINGERPRINT", "").strip()
-INTERVAL_SEC = int(os.getenv("PRUSA_INTERVAL_SEC", "10"))
-WIDTH = int(os.getenv("PRUSA_WIDTH", "1280"))
-HEIGHT = int(os.getenv("PRUSA_HEIGHT", "720"))
-JPEG_QUALITY = int(os.getenv("PRUSA_JPEG_QUALITY", "85"))
-TIMEOUT = float(os.getenv("PRUSA_HTTP_TIMEOUT", "10"))
-PRUSA_AF_MODE = os.getenv("PRUSA_AF_MODE", "cont").strip().lower()
-PRUSA_AF_POSITION = os.getenv("PRUSA_AF_POSITION", "").strip()
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Uploader settings, one field per PRUSA_* environment variable."""
+
+    url: str = "https://webcam.connect.prusa3d.com/c/snapshot"
+    token: str = ""
+    fingerprint: str = ""
+    interval_sec: int = 10
+    width: int = 1280
+    height: int = 720
+    jpeg_quality: int = 85
+    target_kb: int = 300
+    skip_threshold: float = 2.0
+    max_skips: int = 5
+    http_timeout: float = 10
+    af_mode: str = "cont"
+    af_position: str = ""
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        """Build from PRUSA_* variables, e.g. PRUSA_HTTP_TIMEOUT -> http_timeout."""
+        env = {
+            k.removeprefix("PRUSA_").lower(): v.strip()
+            for k, v in os.environ.items()
+            if k.startswith("PRUSA_")
+        }
+        return cls(
+            **{f.name: f.type(env[f.name]) for f in fields(cls) if f.name in env}
+        )
 
 
 # ======== Setup Wizard ========
@@ -118,6 +151,9 @@ def run_setup():
         f.write("PRUSA_WIDTH=1280\n")
         f.write("PRUSA_HEIGHT=720\n")
         f.write("PRUSA_JPEG_QUALITY=85\n")
+        f.write("PRUSA_TARGET_KB=300\n")
+        f.write("PRUSA_SKIP_THRESHOLD=2.0\n")
+        f.write("PRUSA_MAX_SKIPS=5\n")
         f.write("PRUSA_HTTP_TIMEOUT=10\n")
         f.write(f"PRUSA_AF_MODE={af_mode}\n")
         if af_position:
@@ -201,50 +237,168 @@ def get_or_create_fingerprint() -> str:
 
 
 # ======== Camera Handling ========
-def capture_jpeg(picam: Picamera2) -> bytes:
-    tmp = Path("/tmp/prusa_snapshot.jpg")
-    logger.debug(f"Configuring camera: {WIDTH}x{HEIGHT}")
+def load_turbojpeg():
+    """Return a reusable libjpeg-turbo encoder, or None to use Picamera2's encoder."""
+    if TurboJPEG is None:
+        logger.info("PyTurboJPEG not installed; using Picamera2 JPEG encoder")
+        return None
+    try:
+        return TurboJPEG()
+    except (OSError, RuntimeError) as e:
+        logger.warning(f"libturbojpeg unavailable ({e}); using Picamera2 JPEG encoder")
+        return None
+
+
+TJ = load_turbojpeg()
+MIN_JPEG_QUALITY = 35
+
+
+def configure_camera(picam: Picamera2, config: Config) -> None:
+    logger.debug("Configuring camera: %dx%d", config.width, config.height)
     cfg = picam.create_still_configuration(
-        main={"size": (WIDTH, HEIGHT), "format": "RGB888"}
+        main={"size": (config.width, config.height), "format": "RGB888"},
+        lores=None,
+        raw=None,
+        buffer_count=2,
     )
     picam.configure(cfg)
-    picam.options["quality"] = JPEG_QUALITY
-    logger.debug(f"Set JPEG quality to {JPEG_QUALITY}")
-
-    logger.info("Starting camera and capturing image...")
-    picam.start()
-    time.sleep(0.2)
-    picam.capture_file(str(tmp))
-    picam.stop()
-    data = tmp.read_bytes()
-    tmp.unlink(missing_ok=True)
-    logger.info(f"Captured image ({len(data)} bytes)")
+    picam.options["quality"] = config.jpeg_quality
+    logger.debug("Set JPEG quality to %d", config.jpeg_quality)
+
+
+def open_camera(config: Config, cli_af) -> Picamera2:
+    picam = Picamera2()
+    try:
+        configure_camera(picam, config)
+        configure_autofocus(picam, config, cli_af)
+    except Exception:
+        picam.close()  # release the camera so the next Picamera2() can open it
+        raise
+    return picam
+
+
+def encode_jpeg(encoder, arr, jpeg_quality: int, target_kb: int) -> bytes:
+    """Encode a frame, stepping quality down until it fits target_kb (0 = off)."""
+    quality = jpeg_quality
+    # Picamera2's RGB888 is stored in BGR byte order
+    data = encoder.encode(arr, quality=quality, pixel_format=TJPF_BGR)
+    while target_kb and len(data) > target_kb * 1024 and quality > MIN_JPEG_QUALITY:
+        quality = max(MIN_JPEG_QUALITY, quality - 5)
+        data = encoder.encode(arr, quality=quality, pixel_format=TJPF_BGR)
+    if quality != jpeg_quality:
+        logger.info(f"Reduced JPEG quality to {quality} to fit {target_kb} KB")
     return data
 
 
+def frame_signature(arr) -> np.ndarray:
+    """Coarse ~16x16 luma grid of a frame, cheap enough to compare every capture."""
+    h, w = arr.shape[:2]
+    return arr[:: max(h // 16, 1), :: max(w // 16, 1)].mean(axis=2)
+
+
+@dataclass(slots=True)
+class UploadBaseline:
+    """Signature of the last frame Prusa Connect accepted, and skips since then."""
+
+    sig: np.ndarray | None = None
+    skips: int = 0
+
+    def accept(self, sig: np.ndarray) -> None:
+        self.sig = sig
+        self.skips = 0
+
+
+def make_capturer(
+    picam: Picamera2, config: Config, baseline: UploadBaseline, encoder=TJ
+):
+    """Return a capture() closure bound to picam and the chosen encoder.
+
+    capture() returns (jpeg_bytes, signature), or None when the frame barely
+    differs from the last one uploaded, up to max_skips times in a row. The
+    uploader calls baseline.accept(signature) once an upload succeeds.
+    """
+    jpeg_quality = config.jpeg_quality
+    target_kb = config.target_kb
+    skip_threshold = config.skip_threshold
+    max_skips = config.max_skips
+
+    def capture() -> tuple[bytes, np.ndarray] | None:
+        logger.info("Capturing image...")
+        req = picam.capture_request()
+        try:
+            # Work straight from the request's buffer; release only afterwards
+            with MappedArray(req, "main") as m:
+                sig = frame_signature(m.array)
+                last_sig = baseline.sig
+                if (
+                    last_sig is not None
+                    and baseline.skips < max_skips
+                    and np.abs(sig - last_sig).mean() < skip_threshold
+                ):
+                    baseline.skips += 1
+                    logger.info(
+                        f"Frame unchanged, skipping ({baseline.skips}/{max_skips})"
+                    )
+                    return None
+                if encoder is not None:
+                    data = encode_jpeg(encoder, m.array, jpeg_quality, target_kb)
+            if encoder is None:
+                buf = io.BytesIO()
+                req.save("main", buf, format="jpeg")
+                data = buf.getvalue()
+        finally:
+            req.release()
+        logger.info(f"Captured image ({len(data)} bytes)")
+        return data, sig
+
+    return capture
+
+
 # ======== Upload Handling ========
-def upload_snapshot(jpeg_bytes: bytes, token: str, fingerprint: str) -> None:
-    headers = {
-        "accept": "*/*",
-        "content-type": "image/jpeg",
-        "token": token,
-        "fingerprint": fingerprint,
-    }
-    logger.info("Uploading snapshot to Prusa Connect...")
-    resp = requests.put(PRUSA_URL, headers=headers, data=jpeg_bytes, timeout=TIMEOUT)
-    resp.raise_for_status()
-    logger.info(f"Upload successful (HTTP {resp.status_code})")
+class SocketOptionsAdapter(HTTPAdapter):
+    """HTTPAdapter that applies extra socket options to every pooled connection."""
+
+    # urllib3's defaults already disable Nagle (TCP_NODELAY); keep them
+    socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        # Start well above tcp_wmem's 16 KiB default. Linux clamps this to
+        # net.core.wmem_max (about 208 KiB on stock Pi OS), and setting it
+        # explicitly turns off send-buffer autotuning for the socket.
+        (socket.SOL_SOCKET, socket.SO_SNDBUF, 256 * 1024),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+# One keep-alive connection to Prusa Connect, reused across snapshots
+SESSION = requests.Session()
+SESSION.mount("https://", SocketOptionsAdapter(pool_connections=1, pool_maxsize=2))
+
+
+def make_uploader(session: requests.Session, url: str, timeout: float):
+    """Return an upload(jpeg_bytes) closure bound to session, url and timeout."""
+
+    def upload(jpeg_bytes: bytes) -> None:
+        # Keep the body as bytes so requests sends Content-Length, not chunked
+        logger.info("Uploading snapshot to Prusa Connect...")
+        resp = session.put(url, data=jpeg_bytes, timeout=timeout)
+        resp.raise_for_status()
+        logger.info(f"Upload successful (HTTP {resp.status_code})")
+
+    return upload
 
 
 # ======== Autofocus Config ========
-def configure_autofocus(picam, cli_af):
+def configure_autofocus(picam, config: Config, cli_af):
     print("Configuring af")
     if cli_af:  # CLI takes priority
         mode = cli_af[0].lower()
         pos = cli_af[1] if len(cli_af) > 1 else None
     else:  # fallback to env
-        mode = PRUSA_AF_MODE
-        pos = PRUSA_AF_POSITION or None
+        mode = config.af_mode.lower()
+        pos = config.af_position or None
 
     logger.info(f"Configuring autofocus: mode={mode}, position={pos}")
 
@@ -271,48 +425,180 @@ def configure_autofocus(picam, cli_af):
 
 
 # ======== Main Loop ========
-running = True
+MAX_BACKOFF_SEC = 300
+stop_event = threading.Event()
+# Set while the uploader backs off, so the capture thread stops encoding frames
+uploads_paused = threading.Event()
+
+
+def failure_backoff(attempt: int, interval_sec: int) -> float:
+    """Exponential backoff with up to 50% jitter, capped at MAX_BACKOFF_SEC."""
+    delay = interval_sec * (2 ** min(attempt, 6))
+    return min(MAX_BACKOFF_SEC, delay * (1 + random.uniform(0, 0.5)))
+
+
+def offer_frame(frames: queue.Queue, item) -> None:
+    """Put item on a single-slot queue, replacing any frame not yet uploaded."""
+    try:
+        frames.get_nowait()
+    except queue.Empty:
+        pass
+    frames.put_nowait(item)
+
+
+def reopen_camera(config: Config, cli_af, baseline: UploadBaseline):
+    """Open and start a fresh camera; close it again if any step fails."""
+    logger.info("Reopening camera...")
+    picam = open_camera(config, cli_af)
+    try:
+        picam.start()
+        capture = make_capturer(picam, config, baseline)
+    except BaseException:
+        picam.close()
+        raise
+    return picam, capture
+
+
+def capture_loop(
+    picam: Picamera2,
+    config: Config,
+    cli_af,
+    frames: queue.Queue,
+    baseline: UploadBaseline,
+) -> None:
+    """Capture a frame every interval and hand it to the uploader."""
+    interval_sec = config.interval_sec
+    attempt = 0
+    capture = make_capturer(picam, config, baseline)
+    try:
+        while not stop_event.is_set():
+            if uploads_paused.is_set():
+                if stop_event.wait(interval_sec):
+                    break
+                continue
+            try:
+                if picam is None:
+                    picam, capture = reopen_camera(config, cli_af, baseline)
+                frame = capture()
+                if frame is not None:
+                    offer_frame(frames, (*frame, time.monotonic()))
+                attempt = 0
+                delay = interval_sec
+            except MemoryError:
+                # Drop the camera's buffers and start from a fresh allocator
+                logger.error("Out of memory during capture", exc_info=True)
+                stale, picam = picam, None
+                if stale is not None:
+                    stale.close()
+                attempt += 1
+                delay = failure_backoff(attempt, interval_sec)
+            except Exception as e:
+                logger.error(f"Capture error: {e}", exc_info=True)
+                attempt += 1
+                delay = failure_backoff(attempt, interval_sec)
+            if stop_event.wait(delay):
+                break
+    finally:
+        try:
+            if picam is not None:
+                picam.close()
+        finally:
+            offer_frame(frames, None)  # wake the uploader so it can exit
 
 
 def _stop(signum, frame):
-    global running
     logger.info("Termination signal received; stopping...")
-    running = False
-    sys.exit(0)
+    stop_event.set()
 
 
-def main():
-    if not PRUSA_TOKEN:
+def main(config: Config, picam: Picamera2, cli_af):
+    if not config.token:
         logger.error("Missing PRUSA_TOKEN env var")
         raise SystemExit("You must set PRUSA_TOKEN environment variable.")
 
-    fingerprint = PRUSA_FINGERPRINT or get_or_create_fingerprint()
+    fingerprint = config.fingerprint or get_or_create_fingerprint()
     logger.info(f"Using fingerprint: {fingerprint}")
+    SESSION.headers.update(
+        {
+            "accept": "*/*",
+            "content-type": "image/jpeg",
+            "token": config.token,
+            "fingerprint": fingerprint,
+        }
+    )
 
-    logger.info(f"Uploader initialized: URL={PRUSA_URL}, interval={INTERVAL_SEC}s")
-
-    backoff = INTERVAL_SEC
-    while running:
-        try:
-            jpeg = capture_jpeg(picam)
-            upload_snapshot(jpeg, PRUSA_TOKEN, fingerprint)
-            backoff = INTERVAL_SEC
-        except requests.HTTPError as e:
-            try:
-                logger.error(f"HTTP error {e.response.status_code}: {e.response.text}")
-            except Exception:
-                logger.error(f"HTTP error: {e}")
-            backoff = min(max(INTERVAL_SEC * 3, 15), 120)
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}", exc_info=True)
-            backoff = min(max(INTERVAL_SEC * 3, 15), 120)
+    logger.info(
+        f"Uploader initialized: URL={config.url}, interval={config.interval_sec}s"
+    )
 
-        logger.info(f"Next snapshot in {backoff}s...")
-        for _ in range(backoff):
-            if not running:
+    upload = make_uploader(SESSION, config.url, config.http_timeout)
+    attempt = 0
+    last_put = None
+    capture_failed = False
+    frames = queue.Queue(maxsize=1)
+    baseline = UploadBaseline()
+    logger.info("Starting camera...")
+    picam.start()
+    capture_thread = threading.Thread(
+        target=capture_loop,
+        args=(picam, config, cli_af, frames, baseline),
+        name="capture",
+    )
+    capture_thread.start()
+    try:
+        while not stop_event.is_set():
+            item = frames.get()
+            if item is None:
+                capture_failed = not stop_event.is_set()
                 break
-            time.sleep(1)
-
+            jpeg, sig, captured_at = item
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Frame age: %.2fs", time.monotonic() - captured_at)
+            # Prusa Connect rejects snapshots sent less than an interval apart
+            if last_put is not None:
+                wait = config.interval_sec - (time.monotonic() - last_put)
+                if wait > 0 and stop_event.wait(wait):
+                    break
+            last_put = time.monotonic()
+            try:
+                upload(jpeg)
+                baseline.accept(sig)
+                attempt = 0
+                continue
+            except requests.HTTPError as e:
+                try:
+                    logger.error(
+                        f"HTTP error {e.response.status_code}: {e.response.text}"
+                    )
+                except Exception:
+                    logger.error(f"HTTP error: {e}")
+            except Exception as e:
+                logger.error(f"Unexpected error: {e}", exc_info=True)
+
+            attempt += 1
+            backoff = failure_backoff(attempt, config.interval_sec)
+            logger.info(f"Next upload in {backoff:.0f}s...")
+            uploads_paused.set()
+            try:
+                if stop_event.wait(backoff):
+                    break
+            finally:
+                uploads_paused.clear()
+            # Drop the frame queued before the backoff and wait for a fresh one
+            try:
+                if frames.get_nowait() is None:
+                    capture_failed = not stop_event.is_set()
+                    break
+            except queue.Empty:
+                pass
+    finally:
+        stop_event.set()
+        capture_thread.join()
+
+    if capture_failed:
+        # Exit non-zero so systemd's Restart=on-failure brings the service back
+        logger.error("Capture thread stopped unexpectedly")
+        raise SystemExit(1)
     logger.info("Exiting...")
 
 
@@ -327,9 +613,9 @@ if __name__ == "__main__":
         signal.signal(signal.SIGTERM, _stop)
 
         try:
-            picam = Picamera2()
-            configure_autofocus(picam, args.af)
-            main()
+            config = Config.from_env()
+            picam = open_camera(config, args.af)
+            main(config, picam, args.af)
         except Exception as e:
             logger.error(f"Startup error: {e}", exc_info=True)
             sys.exit(1)